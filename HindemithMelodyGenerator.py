@@ -1,11 +1,22 @@
+import asyncio
 import copy
 import datetime
 import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
 import os
+import shutil
 import sys
+import tempfile
 import time
+import urllib.parse
+import zipfile
+import zlib
 from pathlib import Path
-from random import shuffle
+from random import randrange, shuffle
 
 import pygame.midi
 
@@ -22,6 +33,50 @@ class Config:
 
     max_melodies_per_final_interval_subset = 100
 
+    # beyond this many melodies in memory, the largest buckets are spilled
+    # to segment files on disk (None for no limit)
+    max_melodies_in_memory = None
+    spill_folder = None  # system temp folder if None
+
+    # write compressed .mxl files instead of plain .xml
+    export_compressed_music_xml = False
+
+    # two-voice exercises pairing melodies of the same length
+    export_counterpoint_pairs = False
+    max_pairs_per_melody_size = 100
+    # vertical intervals, as semitones above the lower voice
+    counterpoint_opening_intervals = (7, 12)
+    counterpoint_consonances = (0, 3, 4, 7, 8, 9)  # pitch classes
+    counterpoint_perfect_consonances = (0, 7)  # pitch classes
+    counterpoint_max_voice_distance = 19
+
+    # local HTTP query service over the generated melodies
+    serve_melody_sets = False
+    http_host = '127.0.0.1'
+    http_port = 8080
+    http_page_size = 20
+    http_max_page_size = 200
+    http_render_cache_size = 256
+
+    # reuse melody sets generated with identical settings and rules
+    use_result_cache = False
+    result_cache_folder = "cache/"
+    result_cache_max_bytes = 2 * 1024 ** 3
+    result_cache_max_age_seconds = 7 * 24 * 60 * 60
+    # settings that don't change which melodies are generated
+    result_cache_ignored_settings = (
+        'progress_update_seconds', 'last_update_time',
+        'max_melodies_in_memory', 'spill_folder',
+        'export_compressed_music_xml', 'export_counterpoint_pairs',
+        'max_pairs_per_melody_size', 'counterpoint_opening_intervals',
+        'counterpoint_consonances', 'counterpoint_perfect_consonances',
+        'counterpoint_max_voice_distance', 'max_melodies_per_final_interval_subset',
+        'serve_melody_sets', 'http_host', 'http_port', 'http_page_size',
+        'http_max_page_size', 'http_render_cache_size',
+        'use_result_cache', 'result_cache_folder', 'result_cache_max_bytes',
+        'result_cache_max_age_seconds', 'result_cache_ignored_settings',
+    )
+
     min_melody_intervals = 4
     max_melody_intervals = 14
     max_melody_height = 19
@@ -75,6 +130,205 @@ class Tone:
         return name + str(self.get_octave())
 
 
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# A melody rule is plain data: a kind plus the value it is checked against.
+# MelodyRules compiles a collection of them, so the cost of checking a new
+# interval does not grow with the number of rules.
+class Rule:
+    # highest tone minus lowest tone may not exceed value
+    max_range = 'max_range'
+    # no more than value consecutive intervals in the same direction
+    max_same_direction = 'max_same_direction'
+    # no more than value changes of direction
+    max_direction_changes = 'max_direction_changes'
+    # no interval may be used more than value times
+    max_interval_uses = 'max_interval_uses'
+    # no tone may be repeated, apart from the closing tone
+    no_repeated_tones = 'no_repeated_tones'
+    # an interval may only be repeated by the one right after it
+    no_distant_repeated_intervals = 'no_distant_repeated_intervals'
+    # no pair of consecutive intervals may be repeated
+    no_repeated_interval_pairs = 'no_repeated_interval_pairs'
+    # value is (interval, resolutions): the interval must be preceded or
+    # followed by one of the resolutions
+    resolved_interval = 'resolved_interval'
+    # a closing melody needs at least value intervals
+    min_closing_intervals = 'min_closing_intervals'
+    # a closing melody must end with one of the value intervals
+    closing_intervals = 'closing_intervals'
+
+    def __init__(self, kind, value=None):
+        self.kind = kind
+        self.value = value
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Rules of the same kind are merged (the tightest limit wins, windowed rules
+# share one table of forbidden interval triples), and everything a rule needs
+# to know about the earlier intervals is folded into an immutable state that
+# is advanced one interval at a time:
+#
+# ( number of intervals, pitch relative to the first tone, lowest pitch,
+#   highest pitch, last interval, previous window, tones bitmask,
+#   older intervals bitmask, interval uses bitmasks, interval pairs bitmask,
+#   same direction run, direction changes )
+#
+# advance() returns None for a state that breaks a rule.
+class MelodyRules:
+    window_size = 3
+    unlimited = sys.maxsize
+
+    def __init__(self, rules, intervals):
+        self.intervals = tuple(sorted(set(intervals)))
+        self.interval_bits = {}
+        self.pair_bits = {}
+        for i, interval in enumerate(self.intervals):
+            self.interval_bits[interval] = 1 << i
+            for j, following in enumerate(self.intervals):
+                self.pair_bits[(interval, following)] = \
+                    1 << (i * len(self.intervals) + j)
+
+        kinds = {}
+        for rule in rules:
+            kinds.setdefault(rule.kind, []).append(rule.value)
+
+        def limit(kind):
+            return min(kinds.get(kind, [self.unlimited]))
+
+        self.max_range = limit(Rule.max_range)
+        self.max_same_direction = limit(Rule.max_same_direction)
+        self.max_direction_changes = limit(Rule.max_direction_changes)
+        self.max_interval_uses = limit(Rule.max_interval_uses)
+        if self.max_interval_uses == self.unlimited:
+            self.max_interval_uses = 0
+        self.min_closing_intervals = max(
+            kinds.get(Rule.min_closing_intervals, [0]))
+        self.no_repeated_tones = Rule.no_repeated_tones in kinds
+        self.no_distant_repeated_intervals = \
+            Rule.no_distant_repeated_intervals in kinds
+        self.no_repeated_interval_pairs = \
+            Rule.no_repeated_interval_pairs in kinds
+
+        self.closing_intervals = frozenset(self.intervals)
+        for closing in kinds.get(Rule.closing_intervals, []):
+            self.closing_intervals = self.closing_intervals & set(closing)
+
+        self.forbidden_windows = self.compile_windows(
+            kinds.get(Rule.resolved_interval, []))
+
+    def compile_windows(self, resolutions):
+        # windows are the last intervals padded with None at the start of
+        # the melody, so the same table covers the opening intervals
+        windows = [()]
+        for position in range(self.window_size):
+            windows = [w + (x,) for w in windows for x in (None,) + self.intervals
+                       if x is not None or position < self.window_size - 1 and
+                       all(y is None for y in w)]
+
+        forbidden = set()
+        for before, interval, after in windows:
+            for resolved, resolutions_allowed in resolutions:
+                if interval == resolved and \
+                        before not in resolutions_allowed and \
+                        after not in resolutions_allowed:
+                    forbidden.add((before, interval, after))
+        return frozenset(forbidden)
+
+    def generate_intervals(self, length, first_intervals, following_intervals):
+        # Depth-first search for closing melodies of up to length + 1
+        # intervals. Each stack frame holds a prefix's state, the intervals
+        # that may follow it and the index of the next one to try; the
+        # interval list is shared and only valid until the next iteration.
+        advance = self.advance
+        intervals = []
+        for first in first_intervals:
+            intervals.append(first)
+            stack = [[advance(self.initial_state(), first), following_intervals[first], 0]]
+            while stack:
+                frame = stack[-1]
+                state, candidates, index = frame
+                if index == len(candidates):
+                    stack.pop()
+                    intervals.pop()
+                    continue
+                frame[2] = index + 1
+
+                interval = candidates[index]
+                state = advance(state, interval)
+                if state is None:
+                    continue
+                intervals.append(interval)
+                if state[1] == 0:
+                    # back on the first tone
+                    yield intervals
+                    intervals.pop()
+                elif len(stack) < length:
+                    stack.append([state, following_intervals[interval], 0])
+                else:
+                    intervals.pop()
+
+    def initial_state(self):
+        return 0, 0, 0, 0, None, (None,) * (self.window_size - 1), 0, 0, \
+               (0,) * self.max_interval_uses, 0, 0, 0
+
+    def advance(self, state, interval):
+        if state is None:
+            return None
+
+        (count, pitch, low, high, last, window, tones, older, uses, pairs,
+         run, changes) = state
+
+        count += 1
+        pitch += interval
+        if pitch < low:
+            low = pitch
+        elif pitch > high:
+            high = pitch
+        tone_bit = 1 << (2 * pitch if pitch >= 0 else -2 * pitch - 1)
+        interval_bit = self.interval_bits[interval]
+        window = window + (interval,)
+
+        if last is None:
+            run = 1
+        elif (interval > 0) == (last > 0):
+            run += 1
+        else:
+            run = 1
+            changes += 1
+
+        # a melody's first interval is never checked
+        if count > 1:
+            closing = pitch == 0
+            if closing and (count < self.min_closing_intervals or
+                            interval not in self.closing_intervals):
+                return None
+            if self.no_repeated_tones and not closing and tones & tone_bit:
+                return None
+            if self.no_distant_repeated_intervals and older & interval_bit:
+                return None
+            if uses and uses[-1] & interval_bit:
+                return None
+            if self.no_repeated_interval_pairs and \
+                    pairs & self.pair_bits[(last, interval)]:
+                return None
+            if window in self.forbidden_windows or \
+                    high - low > self.max_range or \
+                    run > self.max_same_direction or \
+                    changes > self.max_direction_changes:
+                return None
+
+            older |= self.interval_bits[last]
+            pairs |= self.pair_bits[(last, interval)]
+
+        if uses:
+            uses = tuple(
+                (used | interval_bit) if i == 0 else (used | uses[i - 1] & interval_bit)
+                for i, used in enumerate(uses))
+
+        return count, pitch, low, high, interval, window[1:], tones | tone_bit, \
+            older, uses, pairs, run, changes
+
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 class Melody:
     possible_first_intervals = \
@@ -103,6 +357,13 @@ class Melody:
     perfect_up = (5, 7)
     perfect_down = (-7, -5)
 
+    # bump when the meaning of the rules changes without the tables above
+    # changing, so cached results are not reused
+    rules_version = 1
+
+    # MelodyRules by rule declaration
+    compiled_rules = {}
+
     def __init__(self, melody):
         if melody is None:
             self.tones = [Tone(Config.midi_e3)]  # [ Tone(Config.vocalRanges["bass"][1]) ]
@@ -111,6 +372,32 @@ class Melody:
             self.tones = copy.deepcopy(melody.tones)
             self.intervals = copy.deepcopy(melody.intervals)
 
+    @staticmethod
+    def get_hindemith_chapter_one_rules():
+        # built when asked for, so Config changes made before a run apply
+        return (
+            Rule(Rule.min_closing_intervals, Config.min_melody_intervals),
+            Rule(Rule.closing_intervals, Melody.possible_last_intervals),
+            Rule(Rule.no_repeated_tones),
+            Rule(Rule.no_distant_repeated_intervals),
+            Rule(Rule.max_interval_uses, 2),
+            Rule(Rule.no_repeated_interval_pairs),
+            Rule(Rule.resolved_interval, (-6, Melody.perfect_up)),
+            Rule(Rule.resolved_interval, (6, Melody.perfect_down)),
+            Rule(Rule.max_range, Config.max_melody_height),
+            Rule(Rule.max_same_direction, 4),
+            Rule(Rule.max_direction_changes, Config.max_direction_changes),
+        )
+
+    @staticmethod
+    def get_compiled_rules(rules):
+        key = tuple((rule.kind, rule.value) for rule in rules)
+        if key not in Melody.compiled_rules:
+            Melody.compiled_rules[key] = MelodyRules(
+                rules,
+                Melody.possible_first_intervals + tuple(Melody.possible_following_intervals))
+        return Melody.compiled_rules[key]
+
     def push_interval(self, interval):
         self.intervals.append(interval)
         self.tones.append(Tone(self.tones[-1].midi_note + interval))
@@ -132,126 +419,29 @@ class Melody:
         return len(self.intervals)
 
     def num_direction_changes(self):
+        return self.count_direction_changes(self.intervals)
+
+    @staticmethod
+    def count_direction_changes(intervals):
         direction_changes = 0
-        positive = self.intervals[0] > 0
-        for interval in self.intervals:
+        positive = intervals[0] > 0
+        for interval in intervals:
             if positive is True and interval < 0 or \
                     positive is False and interval > 0:
                 direction_changes += 1
                 positive = not positive
         return direction_changes
 
-    def has_too_large_a_range(self):
-        return self.melody_height() > Config.max_melody_height
-
-    def has_too_many_in_same_direction(self):
-        if self.num_intervals() < 5:
-            return False
-        direction = (self.intervals[-5] > 0)
-        for interval in self.intervals[-4:]:
-            if (interval > 0) != direction:
-                return False
-        return True
-
-    def has_duplicate_tones(self):
-        # ignore melody-final tones
-        if self.tones[0].midi_note == self.tones[-1].midi_note:
-            return False
-        for existing_tone in self.tones[1:-1]:
-            if existing_tone.midi_note == self.tones[-1].midi_note:
-                return True
-        return False
-
-    def has_duplicate_intervals(self):
-        added_interval = self.intervals[-1]
-        for existing_interval in self.intervals[0:-2]:
-            if existing_interval == added_interval:
-                return True
-        return False
-
-    def has_three_sequences_of_two(self):
-        # 3 repeats of same two-tone interval
-        sequence_counts = {}
-        for interval in self.intervals:
-            new_count = sequence_counts.get(interval, 0) + 1
-            if new_count > 2:
-                return True
-            sequence_counts[interval] = new_count
-        return False
-
-    def has_two_sequences_of_three(self):
-        length = self.num_intervals()
-        if length < 4:
-            return False
-        # 2 repeats of longer non-overlapping sequences
-        pattern = (self.intervals[-2], self.intervals[-1])
-        pos = 0
-        while length - pos > 2:
-            intervals = (self.intervals[pos], self.intervals[pos + 1])
-            if pattern == intervals:
-                return True
-            inverted = intervals * -1
-            if pattern == inverted:
-                return True
-            pos += 1
-        return False
-
-    def has_unameliorated_tritone(self):
-        ints = self.num_intervals()
-        if ints < 2:
-            return False
-        elif ints == 2:
-            if self.intervals[0] == -6:
-                if self.intervals[1] not in self.perfect_up:
-                    return True
-            elif self.intervals[0] == 6:
-                if self.intervals[1] not in self.perfect_down:
-                    return True
-        else:
-            if self.intervals[-2] == -6:
-                if self.intervals[-3] not in self.perfect_up and \
-                        self.intervals[-1] not in self.perfect_up:
-                    return True
-            elif self.intervals[-2] == 6:
-                if self.intervals[-3] not in self.perfect_down and \
-                        self.intervals[-1] not in self.perfect_down:
-                    return True
-        return False
-
-    def has_too_many_direction_changes(self):
-        return self.num_direction_changes() > Config.max_direction_changes
-
     # def isComplete(self):
     #    return self.tones[0].midi_note == self.tones[-1].midi_note
 
     def is_illegal_melody_for_hindemith_chapter_one(self):
-        # Some tests assume we just need to check the
-        # most recently appended note
-
-        if len(self.intervals) < 2:
-            return False
-
-        closing = (self.tones[0].midi_note == self.tones[-1].midi_note)
-
-        if closing and len(self.intervals) < Config.min_melody_intervals:
-            return True
-
-        if (self.has_duplicate_tones() or
-                self.has_duplicate_intervals() or
-                self.has_unameliorated_tritone() or
-                self.has_too_large_a_range() or
-                self.has_too_many_in_same_direction() or
-                self.has_two_sequences_of_three() or
-                self.has_three_sequences_of_two() or
-                self.has_too_many_direction_changes()
-        ):
-            return True
-
-        if closing:
-            if self.intervals[-1] not in self.possible_last_intervals:
-                return True
-
-        return False
+        # rule state belongs to the search, so it isn't kept on melodies
+        rules = self.get_compiled_rules(self.get_hindemith_chapter_one_rules())
+        state = rules.initial_state()
+        for interval in self.intervals:
+            state = rules.advance(state, interval)
+        return state is None
 
     def intervals_string(self):
         strings = []
@@ -269,6 +459,21 @@ class Melody:
     def get_name(self):
         return '{0}  /  {1}'.format(self.tones_string(), self.intervals_string())
 
+    def load_intervals(self, intervals):
+        # melodies are stored as interval tuples; their tones are only
+        # worked out here, centred on Config.midi_e3
+        for interval in intervals:
+            self.push_interval(interval)
+
+        midi_tones = [x.midi_note for x in self.tones]
+        max_tone = max(midi_tones)
+        min_tone = min(midi_tones)
+        mid_tone = (max_tone + min_tone) // 2
+        offset = Config.midi_e3 - mid_tone
+
+        for tone in self.tones:
+            tone.midi_note += offset
+
     def print(self):
         print(self.get_name())
 
@@ -288,20 +493,98 @@ class Melody:
         time.sleep(pause)
 
 
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# The melodies of one final interval subset, as interval tuples. Spilled
+# melodies are appended to the bucket's segment file, one per line, and are
+# read back in order ahead of the ones still in memory.
+class MelodyBucket:
+
+    def __init__(self, name):
+        self.name = name
+        self.melodies = []
+        self.segment_file_name = None
+        self.num_spilled = 0
+        self.shuffled = False
+
+    def __len__(self):
+        return self.num_spilled + len(self.melodies)
+
+    def __iter__(self):
+        if self.segment_file_name is not None:
+            with open(self.segment_file_name, mode='r', encoding="utf8") as f:
+                for line in f:
+                    yield self.parse_intervals(line)
+        yield from self.melodies
+
+    def append(self, intervals):
+        self.melodies.append(intervals)
+
+    def spill(self, folder):
+        if self.segment_file_name is None:
+            self.segment_file_name = Path(folder) / (self.name + '.seg')
+        with open(self.segment_file_name, mode='a', encoding="utf8") as f:
+            for intervals in self.melodies:
+                f.write(self.format_intervals(intervals))
+        self.num_spilled += len(self.melodies)
+        self.melodies = []
+
+    def forget_spilled(self):
+        # the segment file is being deleted along with its melodies
+        self.segment_file_name = None
+        self.num_spilled = 0
+        self.shuffled = False
+
+    @staticmethod
+    def format_intervals(intervals):
+        return ' '.join(str(x) for x in intervals) + '\n'
+
+    @staticmethod
+    def parse_intervals(line):
+        return tuple(int(x) for x in line.split())
+
+    def shuffle(self):
+        # spilled melodies are sampled when read back instead
+        if self.num_spilled == 0:
+            shuffle(self.melodies)
+        else:
+            self.shuffled = True
+
+    def get_melodies_up_to(self, count):
+        if not self.shuffled:
+            return list(itertools.islice(self, count))
+        return self.sample_intervals(self, count)
+
+    @staticmethod
+    def sample_intervals(melodies, count):
+        # reservoir sampling, so no more than count melodies are held at once
+        reservoir = []
+        for i, melody in enumerate(melodies):
+            if i < count:
+                reservoir.append(melody)
+            else:
+                j = randrange(i + 1)
+                if j < count:
+                    reservoir[j] = melody
+        shuffle(reservoir)
+        return reservoir
+
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 class MelodiesSubset:
 
     def __init__(self, num_direction_changes, melody_size):
         self.melody_size = melody_size
         self.num_direction_changes = num_direction_changes
-        self.melodies = {x: [] for x in Melody.possible_last_intervals}
+        self.melodies = {
+            x: MelodyBucket('{0}_{1}_{2}'.format(num_direction_changes, melody_size, x))
+            for x in Melody.possible_last_intervals}
 
     def get_name(self):
         return "Melodies with {0} direction changes and length {1}".format(
             self.num_direction_changes, self.melody_size)
 
-    def append(self, melody):
-        self.melodies[melody.intervals[-1]].append(melody)
+    def append(self, intervals):
+        self.melodies[intervals[-1]].append(intervals)
 
     def num_melodies(self):
         lengths = [len(z) for z in self.melodies.values()]
@@ -310,16 +593,29 @@ class MelodiesSubset:
     def get_all_melodies_up_to_max_for_group(self):
         all_melodies = []
         for last_interval in Melody.possible_last_intervals:
-            melodies = self.melodies[last_interval][0:Config.max_melodies_per_final_interval_subset]
-            all_melodies.extend(melodies)
+            melodies = self.melodies[last_interval].get_melodies_up_to(
+                Config.max_melodies_per_final_interval_subset)
+            all_melodies.extend(self.get_melody(x) for x in melodies)
         return all_melodies
 
+    def get_all_melodies(self):
+        for last_interval in Melody.possible_last_intervals:
+            for intervals in self.melodies[last_interval]:
+                yield self.get_melody(intervals)
+
+    def get_melody(self, intervals):
+        melody = Melody(None)
+        melody.load_intervals(intervals)
+        return melody
+
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 class MelodySets:
     melody_count = 0
 
     def __init__(self):
+        self.melodies_in_memory = 0
+        self.spill_folder = None
         self.direction_changes_set = []
         for alt_count in range(0, Config.max_melody_intervals + 2):
             length_set = []
@@ -328,27 +624,23 @@ class MelodySets:
                 length_set.append(MelodiesSubset(alt_count, length_count))
 
     def save_melody(self, melody):
+        self.save_intervals(tuple(melody.intervals))
 
-        self.melody_count += 1
+    def save_intervals(self, intervals):
 
-        melody = Melody(melody)
-        midi_tones = [x.midi_note for x in melody.tones]
-        max_tone = max(midi_tones)
-        min_tone = min(midi_tones)
-        mid_tone = (max_tone + min_tone) // 2
-        offset = Config.midi_e3 - mid_tone
-
-        i = 0
-        while i < melody.num_tones():
-            melody.tones[i].midi_note += offset
-            i += 1
+        self.melody_count += 1
 
-        length = melody.num_tones()
+        length = len(intervals) + 1
 
-        direction_changes = melody.num_direction_changes()
+        direction_changes = Melody.count_direction_changes(intervals)
 
         melody_set = self.direction_changes_set[direction_changes][length]
-        melody_set.append(melody)
+        melody_set.append(intervals)
+
+        self.melodies_in_memory += 1
+        if Config.max_melodies_in_memory is not None and \
+                self.melodies_in_memory > Config.max_melodies_in_memory:
+            self.spill_largest_buckets()
 
         current_time = time.time()
 
@@ -356,37 +648,62 @@ class MelodySets:
         if (current_time - last_update_time) > Config.progress_update_seconds:
             self.print_summary()
             print()
-            melody.print()
+            melody_set.get_melody(intervals).print()
             last_update_time = current_time
 
-    def extend_melody(self, melody, length_remaining):
-
-        previous_interval = melody.intervals[-1]
-        for interval in Melody.possible_following_intervals[previous_interval]:
-            melody.push_interval(interval)
-            if not melody.is_illegal_melody_for_hindemith_chapter_one():
-                if melody.tones[0].midi_note == melody.tones[-1].midi_note:
-                    self.save_melody(melody)
-                elif length_remaining > 0:
-                    self.extend_melody(melody, length_remaining - 1)
-
-            melody.pop_interval()
-
     def generate_melodies(self, length):
-        for interval in Melody.possible_first_intervals:
-            melody = Melody(None)
-            melody.push_interval(interval)
-            self.extend_melody(melody, length - 1)
+        rules = Melody.get_compiled_rules(Melody.get_hindemith_chapter_one_rules())
+        for intervals in rules.generate_intervals(
+                length, Melody.possible_first_intervals, Melody.possible_following_intervals):
+            self.save_intervals(tuple(intervals))
         self.shuffle_if_too_many()
         self.print_summary()
 
-    def shuffle_if_too_many(self):
+    def get_buckets(self):
         for alternation_set in self.direction_changes_set:
             for length_set in alternation_set:
-                for final_interval in Melody.possible_last_intervals:
-                    melodies = length_set.melodies[final_interval]
-                    if len(melodies) > Config.max_melodies_per_final_interval_subset:
-                        shuffle(melodies)
+                yield from length_set.melodies.values()
+
+    def get_all_intervals(self):
+        for bucket in self.get_buckets():
+            yield from bucket
+
+    def merge(self, melody_sets):
+        # interval tuples are canonical, so a melody already present in
+        # either set costs one hash lookup. A tuple can only collide within
+        # its own bucket, so only one bucket's tuples are held at a time;
+        # the largest bucket still has to fit in memory even when spilling.
+        for bucket, other_bucket in zip(self.get_buckets(), melody_sets.get_buckets()):
+            known = set(bucket)
+            for intervals in other_bucket:
+                if intervals not in known:
+                    known.add(intervals)
+                    self.save_intervals(intervals)
+        self.shuffle_if_too_many()
+
+    def spill_largest_buckets(self):
+        # spill down to half the budget so this doesn't run on every save
+        if self.spill_folder is None:
+            self.spill_folder = tempfile.mkdtemp(prefix='melodies-', dir=Config.spill_folder)
+
+        buckets = sorted(self.get_buckets(), key=lambda x: len(x.melodies), reverse=True)
+        for bucket in buckets:
+            if self.melodies_in_memory <= Config.max_melodies_in_memory // 2:
+                break
+            self.melodies_in_memory -= len(bucket.melodies)
+            bucket.spill(self.spill_folder)
+
+    def remove_spilled_melodies(self):
+        if self.spill_folder is not None:
+            shutil.rmtree(self.spill_folder, ignore_errors=True)
+            self.spill_folder = None
+            for bucket in self.get_buckets():
+                bucket.forget_spilled()
+
+    def shuffle_if_too_many(self):
+        for bucket in self.get_buckets():
+            if len(bucket) > Config.max_melodies_per_final_interval_subset:
+                bucket.shuffle()
 
     # def print_prefixes(self):
     #    self.print_summary()
@@ -436,6 +753,246 @@ class MelodySets:
         pygame.midi.quit()
 
 
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Generated melody sets cached on disk under a hash of everything that decides
+# which melodies are generated: the search length, the Config values that
+# aren't in Config.result_cache_ignored_settings, the Melody interval tables,
+# the rules and the rules version. An entry is a gzipped file of interval
+# tuples, one melody per line; entries past the maximum age are evicted, then the least
+# recently used ones until the cache fits in its size limit.
+class ResultCache:
+    extension = '.melodies.gz'
+    format_version = 2
+
+    def __init__(self):
+        self.folder = Path(Config.result_cache_folder)
+
+    def get_key(self, length):
+        settings = sorted(
+            (name, value) for name, value in vars(Config).items()
+            if not name.startswith('_') and name not in Config.result_cache_ignored_settings)
+        rules = [(rule.kind, rule.value) for rule in Melody.get_hindemith_chapter_one_rules()]
+        description = repr((
+            length,
+            settings,
+            Melody.possible_first_intervals,
+            Melody.possible_last_intervals,
+            sorted(Melody.possible_following_intervals.items()),
+            rules,
+            Melody.rules_version,
+            self.format_version,
+        ))
+        return hashlib.sha256(description.encode('utf8')).hexdigest()
+
+    def get_file_name(self, length):
+        return self.folder / (self.get_key(length) + self.extension)
+
+    def load(self, melody_sets, length):
+        file_name = self.get_file_name(length)
+
+        # the open handle keeps the entry readable if another run evicts it
+        try:
+            f = open(file_name, 'rb')
+        except FileNotFoundError:
+            return False
+
+        with f:
+            # check the whole entry first, so a truncated or corrupt one can't
+            # leave melody_sets half loaded
+            try:
+                for _ in self.read_intervals(f):
+                    pass
+            except (OSError, EOFError, ValueError, zlib.error) as error:
+                print("Discarding unreadable ", file_name, ": ", error)
+                file_name.unlink(missing_ok=True)
+                return False
+
+            f.seek(0)
+            for intervals in self.read_intervals(f):
+                melody_sets.save_intervals(intervals)
+        try:
+            os.utime(file_name)
+        except FileNotFoundError:
+            pass
+        print("Loaded ", file_name)
+
+        melody_sets.shuffle_if_too_many()
+        melody_sets.print_summary()
+        return True
+
+    def read_intervals(self, f):
+        with gzip.open(f, mode='rt', encoding="utf8") as lines:
+            for line in lines:
+                yield MelodyBucket.parse_intervals(line)
+
+    def load_or_generate(self, melody_sets, length):
+        if not self.load(melody_sets, length):
+            melody_sets.generate_melodies(length)
+            self.store(melody_sets, length)
+
+    def store(self, melody_sets, length):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        file_name = self.get_file_name(length)
+
+        # written under a temporary name of its own, so a crash can't leave a
+        # partial entry and concurrent runs with the same key don't collide
+        file_descriptor, temp_file_name = tempfile.mkstemp(suffix='.tmp', dir=str(self.folder))
+        os.close(file_descriptor)
+        try:
+            # mkstemp makes the file private; give it the usual permissions so
+            # other accounts sharing the cache can read it
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_file_name, 0o666 & ~umask)
+            with gzip.open(temp_file_name, mode='wt', encoding="utf8") as f:
+                for intervals in melody_sets.get_all_intervals():
+                    f.write(MelodyBucket.format_intervals(intervals))
+            os.replace(temp_file_name, file_name)
+        except BaseException:
+            os.unlink(temp_file_name)
+            raise
+        print("Cached ", file_name)
+
+        self.evict()
+
+    def evict(self):
+        # other runs may be evicting the same entries at the same time
+        now = time.time()
+        entries = []
+        for file_name in self.folder.glob('*' + self.extension):
+            try:
+                status = file_name.stat()
+            except FileNotFoundError:
+                continue
+            if now - status.st_mtime > Config.result_cache_max_age_seconds:
+                file_name.unlink(missing_ok=True)
+            else:
+                entries.append((status.st_mtime, status.st_size, file_name))
+
+        entries.sort()
+        total_size = sum(x[1] for x in entries)
+        for _, size, file_name in entries:
+            if total_size <= Config.result_cache_max_bytes:
+                break
+            file_name.unlink(missing_ok=True)
+            total_size -= size
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+class MelodyPair:
+
+    def __init__(self, lower, upper, opening_interval):
+        self.lower = lower
+        self.upper = upper
+        self.opening_interval = opening_interval
+
+    def num_tones(self):
+        return self.lower.num_tones()
+
+    def get_name(self):
+        return '{0}  |  {1}'.format(
+            self.upper.intervals_string(), self.lower.intervals_string())
+
+    def get_transposed_upper(self):
+        # the upper voice starts opening_interval above the lower voice
+        upper = Melody(self.upper)
+        offset = self.lower.tones[0].midi_note + self.opening_interval - \
+            self.upper.tones[0].midi_note
+        for tone in upper.tones:
+            tone.midi_note += offset
+        return upper
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Pairs melodies of the same length into two-voice exercises. Candidate upper
+# voices are indexed in a trie keyed by the pitch class (relative to the first
+# tone) and contour of each position, so for a given lower voice and opening
+# interval only the branches that stay consonant and avoid parallel perfect
+# intervals are walked, and incompatible partners are dropped together at the
+# first position where they fail.
+#
+# Voice spacing depends on absolute pitches, so it is checked per pair.
+class CounterpointPairer:
+
+    def __init__(self, melody_sets):
+        self.melody_sets = melody_sets
+
+    def get_signature(self, melody):
+        first = melody.tones[0].midi_note
+        signature = []
+        for i in range(1, melody.num_tones()):
+            pitch_class = (melody.tones[i].midi_note - first) % 12
+            contour = 1 if melody.intervals[i - 1] > 0 else -1
+            signature.append((pitch_class, contour))
+        return signature
+
+    def get_melodies(self, melody_size):
+        melodies = []
+        for length_set in self.melody_sets.direction_changes_set:
+            melodies.extend(length_set[melody_size].get_all_melodies_up_to_max_for_group())
+        return melodies
+
+    def build_index(self, melodies):
+        index = {}
+        for melody in melodies:
+            node = index
+            for key in self.get_signature(melody):
+                node = node.setdefault(key, {})
+            node.setdefault(None, []).append(melody)
+        return index
+
+    def generate_pairs(self, melody_size):
+        # Lower voices take turns, in random order, yielding one pair each per
+        # round, so the first pairs taken for export use many different bass
+        # lines rather than every partner of the first few.
+        melodies = self.get_melodies(melody_size)
+        index = self.build_index(melodies)
+        lowers = list(melodies)
+        shuffle(lowers)
+
+        partners = [self.generate_partners(index, lower) for lower in lowers]
+        while len(partners) > 0:
+            remaining = []
+            for pairs in partners:
+                pair = next(pairs, None)
+                if pair is not None:
+                    yield pair
+                    remaining.append(pairs)
+            partners = remaining
+
+    def generate_partners(self, index, lower):
+        signature = self.get_signature(lower)
+        for opening in Config.counterpoint_opening_intervals:
+            for upper in self.match(index, signature, 0, opening, opening % 12):
+                if self.has_legal_spacing(lower, upper, opening):
+                    yield MelodyPair(lower, upper, opening)
+
+    def match(self, node, signature, position, opening, previous_vertical):
+        if position == len(signature):
+            yield from node.get(None, [])
+            return
+
+        lower_pitch_class, lower_contour = signature[position]
+        for vertical in Config.counterpoint_consonances:
+            pitch_class = (vertical - opening + lower_pitch_class) % 12
+            for contour in (1, -1):
+                child = node.get((pitch_class, contour))
+                if child is None:
+                    continue
+                if vertical == previous_vertical and contour == lower_contour and \
+                        vertical in Config.counterpoint_perfect_consonances:
+                    continue
+                yield from self.match(child, signature, position + 1, opening, vertical)
+
+    def has_legal_spacing(self, lower, upper, opening):
+        offset = opening + lower.tones[0].midi_note - upper.tones[0].midi_note
+        for lower_tone, upper_tone in zip(lower.tones, upper.tones):
+            distance = upper_tone.midi_note + offset - lower_tone.midi_note
+            if distance < 0 or distance > Config.counterpoint_max_voice_distance:
+                return False
+        return True
+
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # approx EBNF
 #
@@ -488,16 +1045,48 @@ class MusicXmlExporter:
 
     def export_melodies(self, melody_subset):
         if melody_subset.num_melodies() > 0:
-            xml_doc = []
             name = melody_subset.get_name()
+            self.export_doc(name, lambda doc: self.append_xml_doc(doc, melody_subset, name))
+
+    def export_melody_pairs(self, pairer):
+        for melody_size in range(0, Config.max_melody_intervals + 2):
+            pairs = list(itertools.islice(
+                pairer.generate_pairs(melody_size), Config.max_pairs_per_melody_size))
+            if len(pairs) > 0:
+                name = "Two-voice melodies of length {0}".format(melody_size)
+                self.export_doc(name, lambda doc: self.append_pairs_xml_doc(doc, pairs, name))
+
+    def export_doc(self, name, append_doc):
+        if Config.export_compressed_music_xml:
+            with MxlDocWriter(self.get_file_name(name, '.mxl')) as xml_doc:
+                append_doc(xml_doc)
+        else:
+            xml_doc = []
+            append_doc(xml_doc)
+            self.write_xml_doc(xml_doc, name)
 
-            self.append_file_header(xml_doc, name)
-            self.append_melodies(xml_doc, melody_subset)
-            self.append_file_footer(xml_doc)
+    def append_xml_doc(self, doc, melody_subset, name):
+        self.append_file_header(doc, name, [self.bass_part])
+        self.append_part_start(doc, 1)
+        self.append_melodies(doc, melody_subset)
+        self.append_part_end(doc)
+        self.append_file_footer(doc)
 
-            self.write_xml_doc(xml_doc, name)
+    def append_pairs_xml_doc(self, doc, pairs, name):
+        self.append_file_header(doc, name, [self.tenor_part, self.bass_part])
+
+        self.append_part_start(doc, 1)
+        self.append_pair_voices(doc, [pair.get_transposed_upper() for pair in pairs], self.tenor_part,
+                                [pair.get_name() for pair in pairs])
+        self.append_part_end(doc)
 
-    def append_file_header(self, doc, name):
+        self.append_part_start(doc, 2)
+        self.append_pair_voices(doc, [pair.lower for pair in pairs], self.bass_part, None)
+        self.append_part_end(doc)
+
+        self.append_file_footer(doc)
+
+    def append_file_header(self, doc, name, parts):
         title = 'Python-Generated Hindemith-Compliant Melodies'
         composer = 'Jodawi'
         copyright_notice = 'Public Domain'
@@ -515,21 +1104,60 @@ class MusicXmlExporter:
         )
         doc.append(header)
 
+        for part_number, (part_name, abbreviation, _) in enumerate(parts, 1):
+            doc.append(self.score_part.format(
+                PART_ID=self.get_part_id(part_number),
+                PART_NAME=part_name,
+                PART_ABBREVIATION=abbreviation,
+                MIDI_CHANNEL=part_number))
+        doc.append(self.part_list_end)
+
     def append_file_footer(self, doc):
         doc.append(self.file_footer)
 
+    def get_part_id(self, part_number):
+        return 'P{0}'.format(part_number)
+
+    def append_part_start(self, doc, part_number):
+        doc.append(self.part_start.format(PART_ID=self.get_part_id(part_number)))
+
+    def append_part_end(self, doc):
+        doc.append(self.part_end)
+
     def append_melodies(self, doc, melody_set):
+        prefix = '{0}.{1}'.format(melody_set.num_direction_changes, melody_set.melody_size)
+        self.append_melody_list(doc, melody_set.get_all_melodies_up_to_max_for_group(), prefix)
+
+    def append_melody_list(self, doc, melodies, prefix):
         melody_count = 0
         measure_number = 0
-        for melody in melody_set.get_all_melodies_up_to_max_for_group():
+        for melody in melodies:
             melody_count += 1
-            name = '{0}.{1}.{2}:  {3}'.format(
-                melody_set.num_direction_changes,
-                melody_set.melody_size,
+            name = '{0}.{1}:  {2}'.format(
+                prefix,
                 melody_count,
                 melody.get_name())
             measure_number += self.append_melody(doc, melody, name, melody_count, measure_number)
 
+    def render_melodies(self, melodies, name, prefix):
+        doc = []
+        self.append_file_header(doc, name, [self.bass_part])
+        self.append_part_start(doc, 1)
+        self.append_melody_list(doc, melodies, prefix)
+        self.append_part_end(doc)
+        self.append_file_footer(doc)
+        return ''.join(doc)
+
+    def append_pair_voices(self, doc, melodies, part, names):
+        clef = part[2]
+        measure_number = 0
+        for i in range(len(melodies)):
+            name = None
+            if names is not None:
+                name = '{0}.{1}:  {2}'.format(melodies[i].num_tones(), i + 1, names[i])
+            measure_number = self.append_melody(
+                doc, melodies[i], name, i + 1, measure_number, clef)
+
     def get_melody_measure_width(self, melody):
         shrunken = self.doc_width \
                    - self.first_measure_extra_width \
@@ -541,18 +1169,23 @@ class MusicXmlExporter:
         return self.doc_width - self.first_measure_extra_width - \
                self.get_melody_measure_width(melody) * melody.num_tones()
 
-    def write_xml_doc(self, doc, name):
+    @staticmethod
+    def get_file_name(name, extension):
         # TODO: create folder
         data_folder = Path("out/")
+        return data_folder / (name + extension)
 
-        file_name = data_folder / (name + '.xml')
+    def write_xml_doc(self, doc, name):
+        file_name = self.get_file_name(name, '.xml')
 
         with open(file_name, mode='w', encoding="utf8") as f:
             for item in doc:
                 f.write(item)
             print("Wrote ", file_name)
 
-    def append_melody(self, doc, melody, name, melody_number, measure_number):
+    def append_melody(self, doc, melody, name, melody_number, measure_number, clef=None):
+        if clef is None:
+            clef = self.bass_clef
 
         base_width = self.get_melody_measure_width(melody)
 
@@ -568,11 +1201,11 @@ class MusicXmlExporter:
                 MEASURE_WIDTH=width))
 
             if measure_number == 1:
-                doc.append(self.extra_for_first_measure)
+                doc.append(self.extra_for_first_measure.format(CLEF=clef))
             elif melody_number != 1 and i == 0:
                 doc.append(self.new_system)
 
-            if i == 0:
+            if i == 0 and name is not None:
                 doc.append(self.melody_title.format(MELODY_TITLE=name))
 
             tone = melody.tones[i]
@@ -698,11 +1331,13 @@ justify="center" valign="bottom">©{COPYRIGHT}</credit-words>
     <credit-words default-x="635" default-y="1418" font-size="18" \
 justify="center" valign="top">{SUBTITLE}</credit-words>
   </credit>
-  <part-list>
-    <score-part id="P1">
-      <part-name>Bass</part-name>
-      <part-abbreviation>B</part-abbreviation>
-      <score-instrument id="P1-I1">
+  <part-list>'''
+
+    score_part = '''
+    <score-part id="{PART_ID}">
+      <part-name>{PART_NAME}</part-name>
+      <part-abbreviation>{PART_ABBREVIATION}</part-abbreviation>
+      <score-instrument id="{PART_ID}-I1">
         <instrument-name>ARIA Player</instrument-name>
         <virtual-instrument>
           <virtual-library>Garritan Instruments for Finale</virtual-library>
@@ -710,16 +1345,23 @@ justify="center" valign="top">{SUBTITLE}</credit-words>
         </virtual-instrument>
       </score-instrument>
       <midi-device>ARIA Player</midi-device>
-      <midi-instrument id="P1-I1">
-        <midi-channel>1</midi-channel>
+      <midi-instrument id="{PART_ID}-I1">
+        <midi-channel>{MIDI_CHANNEL}</midi-channel>
         <midi-program>1</midi-program>
         <volume>80</volume>
         <pan>0</pan>
       </midi-instrument>
-    </score-part>
-  </part-list>
+    </score-part>'''
+
+    part_list_end = '''
+  </part-list>'''
+
+    part_start = '''
   <!--=========================================================-->
-  <part id="P1">'''
+  <part id="{PART_ID}">'''
+
+    part_end = '''
+  </part>'''
 
     measure_start = '''
     <measure number="{MEASURE_NUMBER}" width="{MEASURE_WIDTH}">'''
@@ -740,13 +1382,26 @@ justify="center" valign="top">{SUBTITLE}</credit-words>
         <time>
           <beats>1</beats>
           <beat-type>1</beat-type>
-        </time>
+        </time>{CLEF}
+      </attributes>
+      <sound tempo="640"/>'''
+
+    bass_clef = '''
         <clef>
           <sign>F</sign>
           <line>4</line>
-        </clef>
-      </attributes>
-      <sound tempo="640"/>'''
+        </clef>'''
+
+    tenor_clef = '''
+        <clef>
+          <sign>G</sign>
+          <line>2</line>
+          <clef-octave-change>-1</clef-octave-change>
+        </clef>'''
+
+    # ( part name, part abbreviation, clef )
+    bass_part = ('Bass', 'B', bass_clef)
+    tenor_part = ('Tenor', 'T', tenor_clef)
 
     melody_title = '''
       <direction placement="above">
@@ -825,19 +1480,323 @@ valign="top">{MELODY_TITLE}</words>
       </print>'''
 
     file_footer = '''
-  </part>
   <!--=========================================================-->
 </score-partwise>
 '''
 
 
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Compressed MusicXML (.mxl) is a zip archive holding the score plus a
+# META-INF/container.xml that points at it. The score is deflated as it is
+# appended, so the whole document never has to be held in memory.
+class MxlDocWriter:
+    score_name = 'score.xml'
+
+    mimetype = 'application/vnd.recordare.musicxml'
+
+    container = '''\
+<?xml version="1.0" encoding="UTF-8"?>
+<container>
+  <rootfiles>
+    <rootfile full-path="{SCORE_NAME}" \
+media-type="application/vnd.recordare.musicxml+xml"/>
+  </rootfiles>
+</container>
+'''
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.archive = None
+        self.stream = None
+
+    def __enter__(self):
+        self.archive = zipfile.ZipFile(
+            self.file_name, mode='w', compression=zipfile.ZIP_DEFLATED)
+        # the mimetype entry must come first and be stored uncompressed
+        self.archive.writestr(
+            'mimetype', self.mimetype, compress_type=zipfile.ZIP_STORED)
+        self.archive.writestr(
+            'META-INF/container.xml',
+            self.container.format(SCORE_NAME=self.score_name))
+        self.stream = io.TextIOWrapper(
+            self.archive.open(self.score_name, mode='w'),
+            encoding="utf8")
+        return self
+
+    def append(self, item):
+        self.stream.write(item)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream.close()
+        self.archive.close()
+        if exc_type is None:
+            print("Wrote ", self.file_name)
+        else:
+            # a closed archive is well formed, don't leave a truncated score
+            os.remove(self.file_name)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Standard MIDI file (format 0) with the melodies played one after the other,
+# timed like Melody.play_midi: a quarter second per tone, a second between
+# melodies.
+class MidiExporter:
+    ticks_per_quarter = 480
+    microseconds_per_quarter = 500000
+    tone_ticks = 240
+    pause_ticks = 960
+    velocity = 127
+
+    def render_melodies(self, melodies):
+        track = bytearray()
+        self.append_event(track, 0, b'\xff\x51\x03' +
+                          self.microseconds_per_quarter.to_bytes(3, 'big'))
+        self.append_event(track, 0, b'\xc0\x00')
+
+        delay = 0
+        for melody in melodies:
+            for tone in melody.tones:
+                self.append_event(track, delay, bytes((0x90, tone.midi_note, self.velocity)))
+                self.append_event(track, self.tone_ticks, bytes((0x80, tone.midi_note, 0)))
+                delay = 0
+            delay = self.pause_ticks
+        self.append_event(track, delay, b'\xff\x2f\x00')
+
+        header = b'MThd' + (6).to_bytes(4, 'big') + (0).to_bytes(2, 'big') + \
+            (1).to_bytes(2, 'big') + self.ticks_per_quarter.to_bytes(2, 'big')
+        return header + b'MTrk' + len(track).to_bytes(4, 'big') + bytes(track)
+
+    def append_event(self, track, delta_ticks, event):
+        # delta times are variable length quantities, 7 bits per byte
+        quantity = [delta_ticks & 0x7f]
+        delta_ticks >>= 7
+        while delta_ticks > 0:
+            quantity.append(0x80 | (delta_ticks & 0x7f))
+            delta_ticks >>= 7
+        track.extend(reversed(quantity))
+        track.extend(event)
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+class HttpError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# Local HTTP service answering queries over one generated MelodySets.
+#
+# GET /buckets
+#     every non-empty bucket and its melody count
+# GET /melodies?direction_changes=D&length=L[&final_interval=F]
+#               [&page=P&per_page=N | &sample=N][&format=json|musicxml|midi]
+#     a page (from 1) or a random sample of a bucket's melodies; without
+#     final_interval, all final intervals of the subset
+#
+# Pages are rendered off the event loop and kept in an LRU cache; samples are
+# random so they are always rendered afresh. The service is started from a
+# stored result set and doesn't export anything.
+class MelodySetsService:
+    content_types = {
+        'json': 'application/json',
+        'musicxml': 'application/vnd.recordare.musicxml+xml',
+        'midi': 'audio/midi',
+    }
+
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               500: 'Internal Server Error'}
+
+    def __init__(self, melody_sets):
+        self.melody_sets = melody_sets
+        self.render_page = functools.lru_cache(
+            maxsize=Config.http_render_cache_size)(self.render_page)
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        server = await asyncio.start_server(
+            self.handle_client, Config.http_host, Config.http_port)
+        print("Serving melodies on http://{0}:{1}/".format(Config.http_host, Config.http_port))
+        async with server:
+            await server.serve_forever()
+
+    async def handle_client(self, reader, writer):
+        try:
+            try:
+                # readline raises ValueError for lines over the stream limit
+                request_line = await reader.readline()
+                while True:
+                    header = await reader.readline()
+                    if header in (b'\r\n', b'\n', b''):
+                        break
+                method, target, _ = request_line.decode('latin-1').split()
+            except ValueError:
+                raise HttpError(400, 'Malformed request')
+            if method != 'GET':
+                raise HttpError(405, 'Only GET is supported')
+
+            loop = asyncio.get_running_loop()
+            content_type, body = await loop.run_in_executor(None, self.respond, target)
+            status = 200
+        except HttpError as error:
+            status = error.status
+            content_type = 'text/plain; charset=utf-8'
+            body = (str(error) + '\n').encode('utf8')
+        except Exception as error:
+            print("Error answering request: ", repr(error))
+            status = 500
+            content_type = 'text/plain; charset=utf-8'
+            body = b'Internal error\n'
+
+        try:
+            writer.write('HTTP/1.1 {0} {1}\r\n'
+                         'Content-Type: {2}\r\n'
+                         'Content-Length: {3}\r\n'
+                         'Connection: close\r\n'
+                         '\r\n'.format(status, self.reasons[status], content_type, len(body))
+                         .encode('latin-1'))
+            writer.write(body)
+            await writer.drain()
+        except ConnectionError:
+            # the client went away, nothing left to answer
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, target):
+        url = urllib.parse.urlsplit(target)
+        query = {x: y[-1] for x, y in urllib.parse.parse_qs(url.query).items()}
+
+        if url.path == '/buckets':
+            return self.content_types['json'], self.get_buckets()
+        if url.path != '/melodies':
+            raise HttpError(404, 'Unknown path ' + url.path)
+
+        direction_changes = self.get_number(query, 'direction_changes', None)
+        length = self.get_number(query, 'length', None)
+        final_interval = self.get_number(query, 'final_interval', 0)
+        output_format = query.get('format', 'json')
+        if output_format not in self.content_types:
+            raise HttpError(400, 'Unknown format ' + output_format)
+
+        buckets = self.get_query_buckets(direction_changes, length, final_interval)
+
+        if 'sample' in query:
+            count = self.get_number(query, 'sample', None)
+            if count < 1 or count > Config.http_max_page_size:
+                raise HttpError(400, 'Sample size out of range')
+            subset = self.get_subset(direction_changes, length)
+            melodies = [subset.get_melody(x) for x in MelodyBucket.sample_intervals(
+                itertools.chain.from_iterable(buckets), count)]
+            return self.content_types[output_format], self.render(
+                output_format, melodies, direction_changes, length, 1, len(melodies))
+
+        page = self.get_number(query, 'page', 1)
+        per_page = self.get_number(query, 'per_page', Config.http_page_size)
+        num_melodies = sum(len(x) for x in buckets)
+        # page 1 is answered even for an empty bucket, later pages must start
+        # at a melody
+        if page < 1 or per_page < 1 or per_page > Config.http_max_page_size or \
+                (page > 1 and (page - 1) * per_page >= num_melodies):
+            raise HttpError(400, 'Page out of range')
+        return self.content_types[output_format], self.render_page(
+            output_format, direction_changes, length, final_interval, page, per_page)
+
+    def get_number(self, query, name, default):
+        if name not in query:
+            if default is None:
+                raise HttpError(400, 'Missing ' + name)
+            return default
+        try:
+            return int(query[name])
+        except ValueError:
+            raise HttpError(400, 'Bad value for ' + name)
+
+    def get_subset(self, direction_changes, length):
+        try:
+            if direction_changes < 0 or length < 0:
+                raise IndexError
+            return self.melody_sets.direction_changes_set[direction_changes][length]
+        except IndexError:
+            raise HttpError(404, 'No such bucket')
+
+    def get_query_buckets(self, direction_changes, length, final_interval):
+        subset = self.get_subset(direction_changes, length)
+        if final_interval == 0:
+            return [subset.melodies[x] for x in Melody.possible_last_intervals]
+        if final_interval not in subset.melodies:
+            raise HttpError(404, 'No such bucket')
+        return [subset.melodies[final_interval]]
+
+    def get_buckets(self):
+        buckets = []
+        for subset in itertools.chain.from_iterable(self.melody_sets.direction_changes_set):
+            for final_interval, bucket in subset.melodies.items():
+                if len(bucket) > 0:
+                    buckets.append({
+                        'direction_changes': subset.num_direction_changes,
+                        'length': subset.melody_size,
+                        'final_interval': final_interval,
+                        'count': len(bucket),
+                    })
+        return json.dumps(buckets).encode('utf8')
+
+    # wrapped in an LRU cache by __init__
+    def render_page(self, output_format, direction_changes, length, final_interval, page, per_page):
+        start = (page - 1) * per_page
+        buckets = self.get_query_buckets(direction_changes, length, final_interval)
+        subset = self.get_subset(direction_changes, length)
+        melodies = [subset.get_melody(x) for x in itertools.islice(
+            itertools.chain.from_iterable(buckets), start, start + per_page)]
+        return self.render(output_format, melodies, direction_changes, length, start + 1, per_page)
+
+    def render(self, output_format, melodies, direction_changes, length, first, per_page):
+        if output_format == 'midi':
+            return MidiExporter().render_melodies(melodies)
+
+        name = self.get_subset(direction_changes, length).get_name()
+        if output_format == 'musicxml':
+            prefix = '{0}.{1}'.format(direction_changes, length)
+            return MusicXmlExporter().render_melodies(melodies, name, prefix).encode('utf8')
+
+        return json.dumps({
+            'name': name,
+            'first': first,
+            'per_page': per_page,
+            'melodies': [{
+                'name': melody.get_name(),
+                'intervals': melody.intervals,
+                'tones': [tone.get_spelling_and_octave() for tone in melody.tones],
+                'midi_notes': [tone.midi_note for tone in melody.tones],
+            } for melody in melodies],
+        }).encode('utf8')
+
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 def main():
     melody_sets = MelodySets()
-    melody_sets.generate_melodies(Config.max_melody_intervals)
+    try:
+        if Config.serve_melody_sets:
+            # serve the stored result set, only generating it if there is none
+            ResultCache().load_or_generate(melody_sets, Config.max_melody_intervals)
+            MelodySetsService(melody_sets).serve_forever()
+            return
+
+        if Config.use_result_cache:
+            ResultCache().load_or_generate(melody_sets, Config.max_melody_intervals)
+        else:
+            melody_sets.generate_melodies(Config.max_melody_intervals)
+
+        exporter = MusicXmlExporter()
+        exporter.export_melody_sets(melody_sets)
 
-    exporter = MusicXmlExporter()
-    exporter.export_melody_sets(melody_sets)
+        if Config.export_counterpoint_pairs:
+            exporter.export_melody_pairs(CounterpointPairer(melody_sets))
+    finally:
+        melody_sets.remove_spilled_melodies()
 
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~